@@ -14,29 +14,38 @@ If several checkpoints are found inside ../models/api/ckpts we will use the last
 
 Warnings:
 There is an issue of using Flask with Keras: https://github.com/jrosebr1/simple-keras-rest-api/issues/1
-The fix done (using tf.get_default_graph()) will probably not be valid for standalone wsgi container e.g. gunicorn,
-gevent, uwsgi.
+The fix done (each model is loaded in its own graph and session and the prediction function is precompiled at load time)
+is not valid for multi-worker wsgi containers e.g. gunicorn, gevent, uwsgi.
+When serving with gunicorn use a single worker with several threads (see ./webpage/gunicorn.conf.py). Requests do not
+modify the default configuration (each one works with the configuration resolved from its own query args) and hold the
+model they selected until their prediction finishes, so concurrent threads can safely use different models.
 """
 
 import builtins
 from collections import OrderedDict
+from concurrent.futures import Future
+import copy
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 import json
+import mimetypes
 import os
 import pkg_resources
 import re
+import threading
 import warnings
 
 import numpy as np
+import orjson
 import requests
 import tensorflow as tf
 from tensorflow.keras.models import load_model
 from tensorflow.keras import backend as K
 from webargs import fields
 
-from imgclas import paths, utils, config, test_utils
-from imgclas.data_utils import load_class_names, load_class_info, mount_nextcloud
+from imgclas import paths, utils, config, test_utils, model_utils
+from imgclas.batching import BatchScheduler
+from imgclas.data_utils import load_class_names, load_class_info, mount_nextcloud, decode_images_gpu
 from imgclas.train_runfile import train_fn
 
 
@@ -60,14 +69,30 @@ except Exception as e:
 
 # Empty model variables for inference (will be loaded the first time we perform inference)
 loaded_ts, loaded_ckpt = None, None
-graph, model, conf, class_names, class_info = None, None, None, None, None
+loaded_entry = None  # cache entry of the loaded model
+session, model, infer, conf, class_names, class_info, class_meta = None, None, None, None, None, None, None
+
+# Cache of the last loaded models (keyed by (timestamp, ckpt_name)) to quickly switch between them
+model_cache = OrderedDict()
+model_cache_size = 2
+custom_objects = utils.get_custom_objects()
+model_lock = threading.RLock()  # guards the model cache and the swap of the loaded model
+load_lock = threading.Lock()  # load a single model at a time
+loading = {}  # futures of the models being loaded in the background
+
+# Flat (group, key) table of the configuration
+conf_table = tuple((group, g_key)
+                   for group, val in sorted(config.CONF.items())
+                   for g_key in sorted(val.keys()))
+conf_keys = set(g_key for _, g_key in conf_table)  # query args that are configuration options
 
 # Additional parameters
-allowed_extensions = set(['png', 'jpg', 'jpeg', 'PNG', 'JPG', 'JPEG']) # allow only certain file extensions
+allowed_formats = re.compile(r'^image/(png|jpe?g)$', re.IGNORECASE)  # allow only certain file formats
 top_K = 5  # number of top classes predictions to return
+crop_num = 30  # number of crops of each image to feed the model
 
 
-def load_inference_model(timestamp=None, ckpt_name=None):
+def load_inference_model(timestamp=None, ckpt_name=None, acquire=False):
     """
     Load a model for prediction.
 
@@ -77,13 +102,48 @@ def load_inference_model(timestamp=None, ckpt_name=None):
         Name of the timestamp to use. The default is the last timestamp in `./models`.
     * ckpt_name: str
         Name of the checkpoint to use. The default is the last checkpoint in `./models/[timestamp]/ckpts`.
+    * acquire: bool
+        Mark the model as in use so that it is not freed (if evicted from the cache) until `release_model` is called.
+
+    Returns
+    -------
+    Dict with the loaded model objects
+    """
+    global loaded_ts, loaded_ckpt, loaded_entry
+    global session, model, infer, conf, class_names, class_info, class_meta
+
+    # Only look for the model files if the model is not already cached
+    key = (timestamp, ckpt_name)
+    if key not in model_cache:
+        key = find_model(timestamp, ckpt_name)
+
+    # Load the model (if it is not already cached) and set it as the loaded model
+    while True:
+        entry = get_model(key)
+        with model_lock:
+            if entry['evicted']:
+                continue  # the model was removed from the cache before we could use it
+            if entry is not loaded_entry:  # a model reloaded after being evicted is a new entry
+                session, model, infer = entry['session'], entry['model'], entry['infer']
+                conf, class_names, class_info = entry['conf'], entry['class_names'], entry['class_info']
+                class_meta = entry['class_meta']
+                loaded_ts, loaded_ckpt = key
+                loaded_entry = entry
+            if acquire:
+                entry['inflight'] += 1
+            return entry
+
+
+def find_model(timestamp=None, ckpt_name=None):
     """
-    global loaded_ts, loaded_ckpt
-    global graph, model, conf, class_names, class_info
+    Check that the model files exist and fill the default timestamp and checkpoint.
 
+    Returns
+    -------
+    (timestamp, ckpt_name) tuple
+    """
     # Set the timestamp
-    timestamp_list = next(os.walk(paths.get_models_dir()))[1]
-    timestamp_list = sorted(timestamp_list)
+    timestamp_list = list_dir(paths.get_models_dir(), dirs_only=True)
     if not timestamp_list:
         raise Exception(
             "You have no models in your `./models` folder to be used for inference. "
@@ -93,12 +153,11 @@ def load_inference_model(timestamp=None, ckpt_name=None):
     elif timestamp not in timestamp_list:
         raise ValueError(
             "Invalid timestamp name: {}. Available timestamp names are: {}".format(timestamp, timestamp_list))
-    paths.timestamp = timestamp
-    print('Using TIMESTAMP={}'.format(timestamp))
 
     # Set the checkpoint model to use to make the prediction
-    ckpt_list = os.listdir(paths.get_checkpoints_dir())
-    ckpt_list = sorted([name for name in ckpt_list if name.endswith('.h5')])
+    # (paths are built from the timestamp instead of setting `paths.timestamp`, which is shared by all the requests)
+    ckpts_dir = os.path.join(paths.get_models_dir(), timestamp, 'ckpts')
+    ckpt_list = [name for name in list_dir(ckpts_dir) if name.endswith('.h5')]
     if not ckpt_list:
         raise Exception(
             "You have no checkpoints in your `./models/{}/ckpts` folder to be used for inference. ".format(timestamp) +
@@ -108,16 +167,88 @@ def load_inference_model(timestamp=None, ckpt_name=None):
     elif ckpt_name not in ckpt_list:
         raise ValueError(
             "Invalid checkpoint name: {}. Available checkpoint names are: {}".format(ckpt_name, ckpt_list))
-    print('Using CKPT_NAME={}'.format(ckpt_name))
 
-    # Clear the previous loaded model
-    K.clear_session()
+    return timestamp, ckpt_name
+
+
+def get_model(key):
+    """
+    Return a model from the cache. If it is not cached, it is loaded in a background thread while the other models
+    keep serving requests (concurrent requests for the same model wait for the same load).
+    """
+    with model_lock:
+        if key in model_cache:
+            model_cache.move_to_end(key)
+            return model_cache[key]
+        future = loading.get(key)
+        if future is None:
+            future = Future()
+            loading[key] = future
+            threading.Thread(target=background_load, args=(key, future), daemon=True).start()
+    return future.result()
+
+
+def background_load(key, future):
+    """
+    Load a model, add it to the cache and evict the least recently used models
+    """
+    try:
+        with load_lock:
+            print('Using TIMESTAMP={}'.format(key[0]))
+            print('Using CKPT_NAME={}'.format(key[1]))
+            entry = load_model_files(*key)
+
+        with model_lock:
+            model_cache[key] = entry
+            while len(model_cache) > model_cache_size:
+                _, evicted = model_cache.popitem(last=False)
+                evicted['evicted'] = True
+                if evicted['inflight'] == 0:
+                    close_model(evicted)  # otherwise it will be closed when its last request finishes
+        future.set_result(entry)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with model_lock:
+            loading.pop(key, None)
+
+
+def release_model(entry):
+    """
+    Mark that a request has finished using a model (acquired with `load_inference_model(acquire=True)`)
+    """
+    with model_lock:
+        entry['inflight'] -= 1
+        if entry['evicted'] and entry['inflight'] == 0:
+            close_model(entry)
+
+
+def close_model(entry):
+    """
+    Free the memory of a model
+    """
+    entry['batcher'].stop()  # wait for the running batches before closing the session
+    if isinstance(entry['session'], tf.Session):  # ONNX Runtime sessions are freed when dereferenced
+        entry['session'].close()
+
+
+def load_model_files(timestamp, ckpt_name):
+    """
+    Load the model, class names and training configuration of a timestamp.
+    Each model is loaded in its own graph and session so that several models can be kept in memory at the same time.
+
+    Returns
+    -------
+    Dict with the loaded objects
+    """
+    ts_dir = os.path.join(paths.get_models_dir(), timestamp)
+    ckpts_dir = os.path.join(ts_dir, 'ckpts')
 
     # Load the class names and info
-    splits_dir = paths.get_ts_splits_dir()
+    splits_dir = os.path.join(ts_dir, 'dataset_files')
     class_names = load_class_names(splits_dir=splits_dir)
     class_info = None
-    if 'info.txt' in os.listdir(splits_dir):
+    if 'info.txt' in list_dir(splits_dir):
         class_info = load_class_info(splits_dir=splits_dir)
         if len(class_info) != len(class_names):
             warnings.warn("""The 'classes.txt' file has a different length than the 'info.txt' file.
@@ -127,53 +258,157 @@ def load_inference_model(timestamp=None, ckpt_name=None):
     if class_info is None:
         class_info = ['' for _ in range(len(class_names))]
 
+    # Precompute the information returned for each class in the predictions
+    class_meta = {'labels': [str(n) for n in class_names],
+                  'labels_info': [str(i) for i in class_info],
+                  'Google Images': [image_link(n) for n in class_names],
+                  'Wikipedia': [wikipedia_link(n) for n in class_names]}
+
     # Load training configuration
-    conf_path = os.path.join(paths.get_conf_dir(), 'conf.json')
+    conf_path = os.path.join(ts_dir, 'conf', 'conf.json')
     with open(conf_path) as f:
-        conf = json.load(f)
-        update_with_saved_conf(conf)
+        conf = get_saved_conf(json.load(f))
 
     # Load the model
-    model = load_model(os.path.join(paths.get_checkpoints_dir(), ckpt_name),
-                       custom_objects=utils.get_custom_objects())
-    graph = tf.get_default_graph()
+    graph = tf.Graph()
+    with graph.as_default():
+        tfconfig = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+        if conf['serving']['use_xla']:
+            tfconfig.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        session = tf.Session(graph=graph, config=tfconfig)
+        with session.as_default():
+            model = load_model(os.path.join(ckpts_dir, ckpt_name),
+                               custom_objects=custom_objects)
+
+    # Precompile the prediction function so that requests directly run the graph (without going through Keras's
+    # model.predict) and freeze the graph so that no new ops are added to it afterwards
+    infer = session.make_callable(model.outputs[0], feed_list=[model.inputs[0]])
+    graph.finalize()
+
+    precision = conf['serving']['precision']
+    if conf['serving']['runtime'] == 'onnxruntime':
+        # Run the model with ONNX Runtime (the ONNX model is exported once and saved next to the checkpoint)
+        h5_path = os.path.join(ckpts_dir, ckpt_name)
+        onnx_path = os.path.splitext(h5_path)[0] + '.onnx'
+        if not os.path.isfile(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(h5_path):
+            model_utils.export_to_onnx(session=session, model=model, onnx_path=onnx_path)
+        tf_session = session
+        session, infer = model_utils.load_onnx_model(onnx_path=onnx_path, precision=precision)
+        tf_session.close()
+
+    elif precision != 'fp32':
+        # Convert the model to lower precision
+        calib_data = model_utils.get_calibration_data(conf, splits_dir=splits_dir) if precision == 'int8' else None
+        max_batch_size = conf['serving']['max_batch_size'] * crop_num
+        fp32_session = session
+        session, infer = model_utils.optimize_for_inference(session=fp32_session,
+                                                            model=model,
+                                                            precision=precision,
+                                                            max_batch_size=max_batch_size,
+                                                            calib_data=calib_data)
+        fp32_session.close()
+
+    # Warm up the model (so that the first request does not pay for the cuDNN initialization)
+    im_size = conf['model']['image_size']
+    infer(np.zeros((1, im_size, im_size, 3), dtype=np.float32))
+
+    # Scheduler to batch together the images of concurrent prediction requests. The model is only run by the single
+    # consumer thread of its scheduler, so the calls to the model are serialized without needing a lock.
+    batcher = BatchScheduler(predict_fn=infer,
+                             max_batch_size=conf['serving']['max_batch_size'],
+                             batch_timeout_micros=conf['serving']['batch_timeout_micros'],
+                             num_batch_threads=1)
+
+    return {'session': session,
+            'model': model,
+            'infer': infer,
+            'batcher': batcher,
+            'conf': conf,
+            'class_names': class_names,
+            'class_info': class_info,
+            'class_meta': class_meta,
+            'inflight': 0,  # number of requests using the model
+            'evicted': False}
+
+
+def clear_model_cache():
+    """
+    Remove all the models loaded for prediction
+    """
+    global loaded_ts, loaded_ckpt, loaded_entry
+    global session, model, infer
 
-    # Set the model as loaded
-    loaded_ts = timestamp
-    loaded_ckpt = ckpt_name
+    with model_lock:
+        for entry in model_cache.values():
+            entry['evicted'] = True
+            if entry['inflight'] == 0:
+                close_model(entry)
+        model_cache.clear()
+        loaded_ts, loaded_ckpt, loaded_entry = None, None, None
+        session, model, infer = None, None, None
 
 
-def update_with_saved_conf(saved_conf):
+def list_dir(path, dirs_only=False):
+    """
+    Return the sorted names of the files (or subdirectories) inside a directory.
+    The listing is cached until the directory is modified.
     """
-    Update the default YAML configuration with the configuration saved from training
+    return cached_list_dir(path, os.stat(path).st_mtime_ns, dirs_only)
+
+
+@lru_cache(maxsize=32)
+def cached_list_dir(path, mtime, dirs_only):
+    names = sorted(os.listdir(path))
+    if dirs_only:
+        names = [n for n in names if os.path.isdir(os.path.join(path, n))]
+    return tuple(names)
+
+
+def resolve_conf(updates):
     """
-    # Update the default conf with the user input
-    CONF = config.CONF
-    for group, val in sorted(CONF.items()):
-        if group in saved_conf.keys():
-            for g_key, g_val in sorted(val.items()):
-                if g_key in saved_conf[group].keys():
-                    g_val['value'] = saved_conf[group][g_key]
+    Return the configuration dict resulting from updating the default YAML configuration with some values.
+    The default configuration (`config.CONF`) is left untouched so that concurrent requests do not interfere.
 
-    # Check and save the configuration
+    Parameters
+    ----------
+    updates : dict
+        New values keyed by (group, key)
+    """
+    CONF = {group: {g_key: dict(g_val) for g_key, g_val in val.items()} for group, val in config.CONF.items()}
+    for (group, g_key), value in updates.items():
+        CONF[group][g_key]['value'] = value
     config.check_conf(conf=CONF)
-    config.conf_dict = config.get_conf_dict(conf=CONF)
+    return config.get_conf_dict(conf=CONF)
 
 
-def update_with_query_conf(user_args):
+def get_saved_conf(saved_conf):
     """
-    Update the default YAML configuration with the user's input args from the API query
+    Return the configuration of a model, ie. the default YAML configuration updated with the configuration saved from
+    training
     """
-    # Update the default conf with the user input
-    CONF = config.CONF
-    for group, val in sorted(CONF.items()):
-        for g_key, g_val in sorted(val.items()):
-            if g_key in user_args:
-                g_val['value'] = json.loads(user_args[g_key])
+    updates = {(group, g_key): saved_conf[group][g_key]
+               for group, g_key in conf_table
+               if group not in ['testing', 'serving']  # these options are set at prediction time, not at training time
+               and g_key in saved_conf.get(group, {})}
+    return resolve_conf(updates)
 
-    # Check and save the configuration
-    config.check_conf(conf=CONF)
-    config.conf_dict = config.get_conf_dict(conf=CONF)
+
+def get_query_conf(user_args):
+    """
+    Return the configuration resulting from updating the default YAML configuration with the user's input args from
+    the API query. The returned dict is shared by all the requests with the same args, so it must not be modified.
+    """
+    query = frozenset((k, v) for k, v in user_args.items() if k in conf_keys)
+    return resolve_query_conf(query)
+
+
+@lru_cache(maxsize=32)
+def resolve_query_conf(query):
+    query = dict(query)
+    updates = {(group, g_key): orjson.loads(query[g_key])
+               for group, g_key in conf_table
+               if g_key in query}
+    return resolve_conf(updates)
 
 
 def catch_error(f):
@@ -195,20 +430,8 @@ def catch_url_error(url_list):
     if not url_list:
         raise ValueError('Empty query')
 
-    for i in url_list:
-        if not i.startswith('data:image'):  # don't do the checks for base64 encoded images
-
-            # Error catch: Inexistent url
-            try:
-                url_type = requests.head(i).headers.get('content-type')
-            except Exception:
-                raise ValueError("Failed url connection: "
-                                 "Check you wrote the url address correctly.")
-
-            # Error catch: Wrong formatted urls
-            if url_type.split('/')[0] != 'image':
-                raise ValueError("Url image format error: Some urls were not in image format. "
-                                 "Check you didn't uploaded a preview of the image rather than the image itself.")
+    # The connection and the image format of each url are checked when downloading the image (see
+    # data_utils.load_url) to avoid an additional request per url
 
 
 def catch_localfile_error(file_list):
@@ -217,13 +440,11 @@ def catch_localfile_error(file_list):
     if not file_list:
         raise ValueError('Empty query')
 
-    # Error catch: Image format error
-    for f in file_list:
-        extension = os.path.basename(f.content_type).split('/')[-1]
-        # extension = mimetypes.guess_extension(f.content_type)
-        if extension not in allowed_extensions:
-            raise ValueError("Local image format error: "
-                             "At least one file is not in a standard image format ({}).".format(allowed_extensions))
+    # Error catch: Image format error (guess the format from the file name if the client did not send a content type)
+    content_types = [f.content_type or mimetypes.guess_type(f.filename or '')[0] or '' for f in file_list]
+    if not all(allowed_formats.match(c) for c in content_types):
+        raise ValueError("Local image format error: "
+                         "At least one file is not in a standard image format (png, jpg, jpeg).")
 
 
 def warm():
@@ -241,44 +462,48 @@ def predict(**args):
         raise Exception("You must provide either 'url' or 'data' in the payload")
 
     if args['files']:
-        args['files'] = [args['files']]  # patch until list is available
+        if not isinstance(args['files'], list):
+            args['files'] = [args['files']]  # patch until list is available
         return predict_data(args)
     elif args['urls']:
-        args['urls'] = [args['urls']]  # patch until list is available
+        if not isinstance(args['urls'], list):
+            args['urls'] = [args['urls']]
         return predict_url(args)
 
 
+@catch_error
+def predict_batch(**args):
+    """
+    Function to predict a batch of independent images (either urls or files) in a single request.
+    Unlike `predict`, each image gets its own prediction.
+    """
+    if (not any([args['urls'], args['files']]) or
+            all([args['urls'], args['files']])):
+        raise Exception("You must provide either 'url' or 'data' in the payload")
+
+    # Check user configuration
+    conf = get_query_conf(args)
+
+    if args['files']:
+        catch_localfile_error(args['files'])
+        images, filemode = load_files(args['files'], conf)
+        return predict_images(X=images, conf=conf, filemode=filemode, merge=False)
+    else:
+        catch_url_error(args['urls'])
+        return predict_images(X=args['urls'], conf=conf, filemode='url', merge=False)
+
+
 def predict_url(args):
     """
     Function to predict an url
     """
     # Check user configuration
-    update_with_query_conf(args)
-    conf = config.conf_dict
+    conf = get_query_conf(args)
 
     merge = True
     catch_url_error(args['urls'])
 
-    # Load model if needed
-    if loaded_ts != conf['testing']['timestamp'] or loaded_ckpt != conf['testing']['ckpt_name']:
-        load_inference_model(timestamp=conf['testing']['timestamp'],
-                             ckpt_name=conf['testing']['ckpt_name'])
-        conf = config.conf_dict
-
-    # Make the predictions
-    with graph.as_default():
-        pred_lab, pred_prob = test_utils.predict(model=model,
-                                                 X=args['urls'],
-                                                 conf=conf,
-                                                 top_K=top_K,
-                                                 filemode='url',
-                                                 merge=merge,
-                                                 use_multiprocessing=False)  # safer to avoid memory fragmentation in failed queries
-
-    if merge:
-        pred_lab, pred_prob = np.squeeze(pred_lab), np.squeeze(pred_prob)
-
-    return format_prediction(pred_lab, pred_prob)
+    return predict_images(X=args['urls'], conf=conf, filemode='url', merge=merge)
 
 
 def predict_data(args):
@@ -286,54 +511,102 @@ def predict_data(args):
     Function to predict an image in binary format
     """
     # Check user configuration
-    update_with_query_conf(args)
-    conf = config.conf_dict
+    conf = get_query_conf(args)
 
     merge = True
     catch_localfile_error(args['files'])
 
-    # Load model if needed
-    if loaded_ts != conf['testing']['timestamp'] or loaded_ckpt != conf['testing']['ckpt_name']:
-        load_inference_model(timestamp=conf['testing']['timestamp'],
-                             ckpt_name=conf['testing']['ckpt_name'])
-        conf = config.conf_dict
+    images, filemode = load_files(args['files'], conf)
+    return predict_images(X=images, conf=conf, filemode=filemode, merge=merge)
+
+
+def load_files(file_list, conf):
+    """
+    Load the content of the uploaded files in memory
+
+    Returns
+    -------
+    images : list
+        Images in the format specified by filemode
+    filemode : str
+        Filemode to use in the prediction
+    """
+    images = [read_file(f) for f in file_list]
+    filemode = 'bytes'
+
+    # Decode the images on the GPU
+    if conf['serving']['gpu_decode']:
+        images = decode_images_gpu(images, batch_size=conf['serving']['max_batch_size'])
+        filemode = 'array'
 
-    # Create a list with the path to the images
-    filenames = [f.filename for f in args['files']]
+    return images, filemode
 
-    # Make the predictions
+
+def predict_images(X, conf, filemode, merge=True):
+    """
+    Predict a list of images with the model selected in the configuration
+    """
+    # Load model if needed (the model is held until the prediction finishes, even if another request switches the
+    # loaded model in the meantime)
+    entry = load_inference_model(timestamp=conf['testing']['timestamp'],
+                                 ckpt_name=conf['testing']['ckpt_name'],
+                                 acquire=True)
     try:
-        with graph.as_default():
-            pred_lab, pred_prob = test_utils.predict(model=model,
-                                                     X=filenames,
-                                                     conf=conf,
-                                                     top_K=top_K,
-                                                     filemode='local',
-                                                     merge=merge,
-                                                     use_multiprocessing=False)  # safer to avoid memory fragmentation in failed queries
+        # Use the configuration of the model (the query only sets the testing options)
+        conf = dict(entry['conf'], testing=conf['testing'])
+
+        # Make the predictions
+        pred_lab, pred_prob = test_utils.predict(model=entry['model'],
+                                                 X=X,
+                                                 conf=conf,
+                                                 top_K=top_K,
+                                                 crop_num=crop_num,
+                                                 filemode=filemode,
+                                                 merge=merge,
+                                                 batcher=entry['batcher'])
     finally:
-        for f in filenames:
-            os.remove(f)
+        release_model(entry)
 
     if merge:
         pred_lab, pred_prob = np.squeeze(pred_lab), np.squeeze(pred_prob)
+        return format_prediction(pred_lab, pred_prob, meta=entry['class_meta'])
+    else:
+        return [format_prediction(lab, prob, meta=entry['class_meta']) for lab, prob in zip(pred_lab, pred_prob)]
 
-    return format_prediction(pred_lab, pred_prob)
 
+def read_file(f):
+    """
+    Return the content of an uploaded file.
+    Flask's FileStorage objects are read directly from memory while DEEPaaS's UploadedFile objects (which are spooled
+    to a temporary file) are read once and the temporary file is removed.
+    """
+    if hasattr(f, 'read'):
+        return f.read()
+    try:
+        with open(f.filename, 'rb') as fb:
+            return fb.read()
+    finally:
+        os.remove(f.filename)
+
+
+def format_prediction(labels, probabilities, meta=None):
 
-def format_prediction(labels, probabilities):
+    meta = class_meta if meta is None else meta  # default to the loaded model
+    labels = np.ravel(labels).tolist()
+    probabilities = np.ravel(probabilities).astype(float).tolist()
 
-    pred = {'labels': [class_names[i] for i in labels],
-            'probabilities': [float(p) for p in probabilities],
-            'labels_info': [class_info[i] for i in labels],
-            'links': {'Google Images': [image_link(class_names[i]) for i in labels],
-                      'Wikipedia': [wikipedia_link(class_names[i]) for i in labels]
+    pred = {'labels': [meta['labels'][i] for i in labels],
+            'probabilities': probabilities,
+            'labels_info': [meta['labels_info'][i] for i in labels],
+            'links': {'Google Images': [meta['Google Images'][i] for i in labels],
+                      'Wikipedia': [meta['Wikipedia'][i] for i in labels]
                       }
             }
 
     return pred
 
 
+@lru_cache(maxsize=None)
 def image_link(pred_lab):
     """
     Return link to Google images
@@ -344,6 +617,7 @@ def image_link(pred_lab):
     return link
 
 
+@lru_cache(maxsize=None)
 def wikipedia_link(pred_lab):
     """
     Return link to wikipedia webpage
@@ -357,11 +631,11 @@ def train(**args):
     """
     Train an image classifier
     """
-    update_with_query_conf(user_args=args)
-    CONF = config.conf_dict
+    CONF = copy.deepcopy(get_query_conf(args))  # the training modifies the configuration
     timestamp = datetime.now().strftime('%Y-%m-%d_%H%M%S')
     config.print_conf_table(CONF)
-    K.clear_session()  # remove the model loaded for prediction
+    clear_model_cache()  # remove the models loaded for prediction
+    K.clear_session()
     train_fn(TIMESTAMP=timestamp, CONF=CONF)
 
     # Sync with NextCloud folders (if NextCloud is available)
@@ -395,12 +669,12 @@ def populate_parser(parser, default_conf):
             help += "</font>"
 
             # Create arg dict
-            opt_args = {'missing': json.dumps(g_val['value']),
+            opt_args = {'missing': orjson.dumps(g_val['value']).decode(),
                         'description': help,
                         'required': False,
                         }
             if choices:
-                opt_args['enum'] = [json.dumps(i) for i in choices]
+                opt_args['enum'] = [orjson.dumps(i).decode() for i in choices]
 
             parser[g_key] = fields.Str(**opt_args)
 
@@ -429,13 +703,12 @@ def get_predict_args():
 
     # Add options for modelname
     timestamp = default_conf['testing']['timestamp']
-    timestamp_list = next(os.walk(paths.get_models_dir()))[1]
-    timestamp_list = sorted(timestamp_list)
+    timestamp_list = list_dir(paths.get_models_dir(), dirs_only=True)
     if not timestamp_list:
         timestamp['value'] = ''
     else:
         timestamp['value'] = timestamp_list[-1]
-        timestamp['choices'] = timestamp_list
+        timestamp['choices'] = list(timestamp_list)
 
     # Add data and url fields
     parser['files'] = fields.Field(required=False,
@@ -446,11 +719,13 @@ def get_predict_args():
                                    description="Select the image you want to classify.")
 
     # Use field.String instead of field.Url because I also want to allow uploading of base 64 encoded data strings
-    parser['urls'] = fields.String(required=False,
-                                   missing=None,
-                                   description="Select an URL of the image you want to classify.")
+    parser['urls'] = fields.List(fields.String(),
+                                 required=False,
+                                 missing=None,
+                                 description="Select the URLs of the images you want to classify (repeat the "
+                                             "argument to provide several URLs).")
 
-    # missing action="append" --> append more than one url
+    # missing action="append" for files --> not yet supported by DEEPaaS for file fields
 
     return populate_parser(parser, default_conf)
 
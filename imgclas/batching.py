@@ -0,0 +1,145 @@
+"""
+Server-side dynamic batching for inference.
+
+Requests push their inputs to a queue and a consumer thread coalesces the pending inputs (up to a maximum batch size
+or a maximum waiting time) into a single batch before calling the model. This follows the design of the TF-Serving
+batching core [1].
+
+References
+----------
+[1] https://github.com/tensorflow/serving/blob/master/tensorflow_serving/batching/README.md
+"""
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class BatchScheduler(object):
+    """
+    Coalesce inference requests into batches.
+    Each submitted item is a numpy array with a leading batch dimension (eg. all the crops of a single image).
+    """
+
+    def __init__(self, predict_fn, max_batch_size=4, batch_timeout_micros=5000, num_batch_threads=1):
+        """
+        Parameters
+        ----------
+        predict_fn : callable
+            Function that maps an input batch of shape (N, H, W, C) to an output array of shape (N, ...).
+        max_batch_size : int
+            Maximum number of items to coalesce in a single batch.
+        batch_timeout_micros : int
+            Maximum time (in microseconds) to wait for a batch to be filled before running it.
+        num_batch_threads : int
+            Number of consumer threads running batches in parallel.
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.batch_timeout_micros = batch_timeout_micros
+        self.num_batch_threads = num_batch_threads
+
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.local = threading.local()  # per-thread input buffers
+
+    def submit(self, x):
+        """
+        Queue an item for prediction.
+
+        Parameters
+        ----------
+        x : numpy array, shape (N, H, W, C)
+
+        Returns
+        -------
+        A concurrent.futures.Future whose result is the output array of shape (N, ...)
+        """
+        self.start()
+        future = Future()
+        self.queue.put((x, future))
+        return future
+
+    def start(self):
+        """
+        Launch the consumer threads (if not already running)
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.num_batch_threads):
+                t = threading.Thread(target=self._consume, daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def stop(self):
+        """
+        Stop the consumer threads (once the pending items have been processed) and wait for them to finish, so that
+        the model is no longer in use when this returns.
+        """
+        with self.lock:
+            for _ in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                if t is not threading.current_thread():
+                    t.join()
+            self.threads = []
+
+    def _next_batch(self):
+        item = self.queue.get()  # block until there is at least one item
+        if item is None:
+            return None
+        items = [item]
+        deadline = time.monotonic() + self.batch_timeout_micros / 1e6
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)  # leave the stop signal for the next iteration
+                break
+            items.append(item)
+        return items
+
+    def _get_buffer(self, n, shape, dtype):
+        """
+        Return an input buffer of shape (n, *shape). Buffers are reused across batches (and only grown when a larger
+        batch arrives) to avoid allocating a new input array for each batch.
+        """
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        key = (shape, np.dtype(dtype))
+        buf = self.local.buffers.get(key)
+        if buf is None or len(buf) < n:
+            buf = np.empty((n,) + shape, dtype=dtype)
+            self.local.buffers[key] = buf
+        return buf[:n]
+
+    def _consume(self):
+        while True:
+            items = self._next_batch()
+            if items is None:
+                return
+            try:
+                xs = [x for x, _ in items]
+                batch = self._get_buffer(sum(len(x) for x in xs), xs[0].shape[1:], xs[0].dtype)
+                np.concatenate(xs, axis=0, out=batch)
+                output = self.predict_fn(batch)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            # Split the output back into the individual requests
+            start = 0
+            for x, future in items:
+                future.set_result(output[start:start + len(x)])
+                start += len(x)
@@ -17,6 +17,7 @@ import base64
 
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from tensorflow.keras.utils import to_categorical, Sequence
 import cv2
@@ -29,6 +30,16 @@ import copy
 import skimage.segmentation
 
 
+# GPU image decoding pipeline (built the first time it is used)
+gpu_decoder = {}
+gpu_decoder_lock = threading.Lock()
+
+# Session to reuse the connections when downloading images
+http = requests.Session()
+http.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+http.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+
 def load_data_splits(splits_dir, im_dir, split_name='train'):
     """
     Load the data arrays from the [train/val/test].txt files.
@@ -105,17 +116,55 @@ def load_class_info(splits_dir):
     return class_info
 
 
+def load_url(url, timeout=5):
+    """
+    Download the content of an image url (or decode a base64 encoded image).
+    The image format is checked from the response headers before downloading the image.
+
+    Parameters
+    ----------
+    url : str
+    timeout : float
+        Timeout (in seconds) of the connection
+
+    Returns
+    -------
+    Bytes of the encoded image
+    """
+    if url.startswith('data:image'):  # base64 encoded string
+        try:
+            return base64.b64decode(url.split(';base64,')[1])
+        except Exception:
+            raise ValueError('Incorrect url path: \n {}'.format(url))
+
+    # Error catch: Inexistent url
+    try:
+        r = http.get(url, stream=True, timeout=timeout)
+    except Exception:
+        raise ValueError("Failed url connection: "
+                         "Check you wrote the url address correctly.")
+
+    with r:
+        # Error catch: Wrong formatted urls
+        if not r.headers.get('content-type', '').startswith('image/'):
+            raise ValueError("Url image format error: Some urls were not in image format. "
+                             "Check you didn't uploaded a preview of the image rather than the image itself.")
+        return r.content
+
+
 def load_image(filename, filemode='local'):
     """
     Function to load a local image path (or an url) into a numpy array.
 
     Parameters
     ----------
-    filename : str
-        Path or url to the image
-    filemode : {'local','url'}
+    filename : str or bytes
+        Path or url to the image (or the raw encoded image if filemode is 'bytes')
+    filemode : {'local','url','bytes','array'}
         - 'local': filename is absolute path in local disk.
         - 'url': filename is internet url.
+        - 'bytes': filename is the content of an encoded image file (eg. the bytes of a jpg file).
+        - 'array': filename is an already decoded RGB image (numpy array).
 
     Returns
     -------
@@ -126,17 +175,18 @@ def load_image(filename, filemode='local'):
         if image is None:
             raise ValueError('The local path does not exist or does not correspond to an image: \n {}'.format(filename))
 
+    elif filemode == 'bytes':
+        image = cv2.imdecode(np.frombuffer(filename, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError('The uploaded file does not correspond to an image.')
+
+    elif filemode == 'array':
+        return filename
+
     elif filemode == 'url':
-        try:
-            if filename.startswith('data:image'):  # base64 encoded string
-                data = base64.b64decode(filename.split(';base64,')[1])
-            else:  # normal url
-                data = requests.get(filename).content
-            data = np.frombuffer(data, np.uint8)
-            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
-            if image is None:
-                raise Exception
-        except:
+        data = load_url(filename)
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
             raise ValueError('Incorrect url path: \n {}'.format(filename))
 
     else:
@@ -146,6 +196,57 @@ def load_image(filename, filemode='local'):
     return image
 
 
+def decode_images_gpu(data_list, batch_size=8):
+    """
+    Decode a list of encoded images on the GPU with NVIDIA DALI (nvJPEG). If DALI is not available the images are
+    decoded on the CPU.
+
+    Parameters
+    ----------
+    data_list : list of bytes
+        Contents of encoded image files
+    batch_size : int
+        Number of images decoded at once (only used when building the decoding pipeline)
+
+    Returns
+    -------
+    List of numpy arrays (RGB images)
+    """
+    try:
+        from nvidia.dali import fn, pipeline_def, types
+    except ImportError:
+        warnings.warn("NVIDIA DALI is not installed, images will be decoded on the CPU.")
+        return [load_image(d, filemode='bytes') for d in data_list]
+
+    with gpu_decoder_lock:
+        if 'pipe' not in gpu_decoder:
+            @pipeline_def(batch_size=batch_size, num_threads=4, device_id=0)
+            def decoding_pipeline():
+                raw = fn.external_source(name='raw')
+                return fn.decoders.image(raw, device='mixed', output_type=types.RGB)
+
+            gpu_decoder['pipe'] = decoding_pipeline()
+            gpu_decoder['pipe'].build()
+        pipe = gpu_decoder['pipe']
+
+        images = []
+        for i in range(0, len(data_list), pipe.max_batch_size):
+            chunk = data_list[i:i + pipe.max_batch_size]
+            pipe.feed_input('raw', [np.frombuffer(d, dtype=np.uint8) for d in chunk])
+            try:
+                out, = pipe.run()
+            except Exception:
+                # A pipeline that failed can no longer be used, so it is rebuilt in the next call. The remaining images
+                # are decoded on the CPU, which raises an error for the specific file that is not an image.
+                gpu_decoder.pop('pipe', None)
+                images += [load_image(d, filemode='bytes') for d in data_list[i:]]
+                break
+            out = out.as_cpu()  # the augmentation of the crops is done on the CPU
+            images += [np.array(out.at(j)) for j in range(len(chunk))]
+
+    return images
+
+
 def preprocess_batch(batch, mean_RGB, std_RGB, mode='tf', channels_first=False):
     """
     Standardize batch to feed the net. Adapted from [1] to take replace the default imagenet mean and std.
@@ -165,18 +266,23 @@ def preprocess_batch(batch, mean_RGB, std_RGB, mode='tf', channels_first=False):
     """
     assert type(batch) is list, "Your batch must be a list of numpy arrays"
 
-    mean_RGB, std_RGB = np.array(mean_RGB), np.array(std_RGB)
-    batch = np.array(batch) - mean_RGB[None, None, None, :]  # mean centering
+    mean_RGB, std_RGB = np.array(mean_RGB, dtype=np.float32), np.array(std_RGB, dtype=np.float32)
+
+    # Copy the images into a preallocated float32 array and standardize it in place (avoids intermediate copies)
+    out = np.empty((len(batch),) + batch[0].shape, dtype=np.float32)
+    for i, im in enumerate(batch):
+        out[i] = im
+    np.subtract(out, mean_RGB, out=out)  # mean centering
 
     if mode == 'caffe':
-        batch = batch[:, :, :, ::-1]  # switch from RGB to BGR
+        out = out[:, :, :, ::-1]  # switch from RGB to BGR
     if mode == 'tf':
-        batch /= 127.5 # scaling between [1, -1]
+        np.divide(out, 127.5, out=out)  # scaling between [1, -1]
     if mode == 'torch':
-        batch /= std_RGB
+        np.divide(out, std_RGB, out=out)
     if channels_first:
-        batch = batch.transpose(0, 3, 1, 2)  # shape(N, 3, 224, 224)
-    return batch.astype(np.float32)
+        out = out.transpose(0, 3, 1, 2)  # shape(N, 3, 224, 224)
+    return np.ascontiguousarray(out)
 
 
 def augment(im, params=None):
@@ -547,6 +653,8 @@ class k_crop_data_sequence(Sequence):
         filemode : {'local','url'}
             - 'local': filename is absolute path in local disk.
             - 'url': filename is internet url.
+            - 'bytes': filename is the content of an encoded image file.
+            - 'array': filename is an already decoded RGB image.
         """
         self.inputs = inputs
         self.mean_RGB = mean_RGB
@@ -562,9 +670,14 @@ class k_crop_data_sequence(Sequence):
         return len(self.inputs)
 
     def __getitem__(self, idx):
-        batch_X = []
         im = load_image(self.inputs[idx], filemode=self.filemode)
+        return self.crop_image(im)
 
+    def crop_image(self, im):
+        """
+        Return the preprocessed batch of crops of an already loaded image
+        """
+        batch_X = []
         if self.crop_mode == 'random':
             for _ in range(self.crop_number):
                 if self.aug_params:
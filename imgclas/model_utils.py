@@ -11,6 +11,7 @@ import os
 import json
 
 import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import applications
 from tensorflow.keras import regularizers
@@ -22,6 +23,7 @@ from tensorflow.python.saved_model import tag_constants
 from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Flatten
 
 from imgclas import paths, config, utils
+from imgclas.data_utils import load_data_splits, k_crop_data_sequence
 
 
 model_modes = {'DenseNet121': 'torch', 'DenseNet169': 'torch', 'DenseNet201': 'torch',
@@ -105,6 +107,168 @@ def export_h5_to_pb(path_to_h5, export_path):
     save_to_pb(model, export_path)
 
 
+def freeze_graph(session, model):
+    """
+    Return the graph of a loaded Keras model with the variables converted to constants
+
+    Parameters
+    ----------
+    session: tf.Session
+        Session where the model was loaded
+    model: Keras model instance
+
+    Returns
+    -------
+    tf.GraphDef
+    """
+    return tf.graph_util.convert_variables_to_constants(session,
+                                                        session.graph.as_graph_def(),
+                                                        [model.outputs[0].op.name])
+
+
+def export_to_onnx(session, model, onnx_path):
+    """
+    Export a loaded Keras model to ONNX
+
+    Parameters
+    ----------
+    session: tf.Session
+        Session where the model was loaded
+    model: Keras model instance
+    onnx_path: str
+        Path where to save the ONNX model
+    """
+    import tf2onnx
+
+    tf2onnx.convert.from_graph_def(freeze_graph(session, model),
+                                   input_names=[model.inputs[0].name],
+                                   output_names=[model.outputs[0].name],
+                                   output_path=onnx_path)
+
+
+def load_onnx_model(onnx_path, precision='fp32'):
+    """
+    Load an ONNX model with ONNX Runtime, using the TensorRT/CUDA execution providers if available.
+
+    Parameters
+    ----------
+    onnx_path: str
+    precision: str, {'fp32', 'fp16'}
+
+    Returns
+    -------
+    ort_session: onnxruntime.InferenceSession
+    infer: callable
+        Function that maps an input batch to the model output
+    """
+    import onnxruntime as ort
+
+    if precision not in ['fp32', 'fp16']:
+        raise ValueError('The {} precision is not supported with ONNX Runtime.'.format(precision))
+
+    providers = [('TensorrtExecutionProvider', {'trt_fp16_enable': precision == 'fp16'}),
+                 'CUDAExecutionProvider',
+                 'CPUExecutionProvider']
+    providers = [p for p in providers if (p[0] if isinstance(p, tuple) else p) in ort.get_available_providers()]
+    ort_session = ort.InferenceSession(onnx_path, providers=providers)
+
+    input_name, output_name = ort_session.get_inputs()[0].name, ort_session.get_outputs()[0].name
+    infer = lambda x: ort_session.run([output_name], {input_name: x})[0]
+
+    return ort_session, infer
+
+
+def optimize_for_inference(session, model, precision='fp16', max_batch_size=1, calib_data=None):
+    """
+    Freeze the graph of a loaded Keras model and optimize it with TF-TRT to run with lower precision.
+
+    Parameters
+    ----------
+    session: tf.Session
+        Session where the model was loaded
+    model: Keras model instance
+    precision: str, {'fp32', 'fp16', 'int8'}
+    max_batch_size: int
+        Maximum batch size that will be fed to the model
+    calib_data: keras Sequence
+        Batches of preprocessed images used to calibrate the int8 ranges. Mandatory if precision is 'int8'.
+
+    Returns
+    -------
+    trt_session: tf.Session
+        Session holding the optimized graph
+    infer: callable
+        Function that maps an input batch to the model output
+    """
+    from tensorflow.python.compiler.tensorrt import trt_convert as trt
+
+    input_name, output_name = model.inputs[0].name, model.outputs[0].name
+    output_node = model.outputs[0].op.name
+
+    # Freeze the graph and optimize it
+    frozen_graph = freeze_graph(session, model)
+    converter = trt.TrtGraphConverter(input_graph_def=frozen_graph,
+                                      nodes_blacklist=[output_node],
+                                      precision_mode=precision.upper(),
+                                      max_batch_size=max_batch_size,
+                                      is_dynamic_op=True,
+                                      use_calibration=(precision == 'int8'))
+    trt_graph = converter.convert()
+
+    if precision == 'int8':
+        calib_iter = iter(calib_data[i] for i in range(len(calib_data)))
+        trt_graph = converter.calibrate(fetch_names=[output_name],
+                                        num_runs=len(calib_data),
+                                        feed_dict_fn=lambda: {input_name: next(calib_iter)})
+
+    # Load the optimized graph in a new session
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(trt_graph, name='')
+    tfconfig = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+    trt_session = tf.Session(graph=graph, config=tfconfig)
+    infer = trt_session.make_callable(graph.get_tensor_by_name(output_name),
+                                      feed_list=[graph.get_tensor_by_name(input_name)])
+    graph.finalize()
+
+    return trt_session, infer
+
+
+def get_calibration_data(conf, splits_dir, num_images=100, crop_num=10):
+    """
+    Return a random sample of preprocessed training images of a model, to be used for calibration.
+
+    Parameters
+    ----------
+    conf: dict
+        Training configuration of the model
+    splits_dir: str
+        Path to the data splits of the model (ie. `./models/[timestamp]/dataset_files`)
+    num_images: int
+        Number of images to sample
+    crop_num: int
+        Number of crops of each image
+
+    Returns
+    -------
+    Keras Sequence where each batch are the crops of a single image
+    """
+    X, _ = load_data_splits(splits_dir=splits_dir,
+                            im_dir=paths.get_images_dir(),
+                            split_name='train')
+    X = np.random.choice(X, size=min(num_images, len(X)), replace=False)
+
+    return k_crop_data_sequence(inputs=X,
+                                im_size=conf['model']['image_size'],
+                                mean_RGB=conf['dataset']['mean_RGB'],
+                                std_RGB=conf['dataset']['std_RGB'],
+                                preprocess_mode=conf['model']['preprocess_mode'],
+                                aug_params=conf['augmentation']['val_mode'],
+                                crop_mode='random',
+                                crop_number=crop_num,
+                                filemode='local')
+
+
 def save_conf(conf):
     """
     Save CONF to a txt file to ease the reading and to a json file to ease the parsing.
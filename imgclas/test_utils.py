@@ -7,12 +7,15 @@ Email: iheredia@ifca.unican.es
 Github: ignacioheredia
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
 import numpy as np
 
-from imgclas.data_utils import k_crop_data_sequence
+from imgclas.data_utils import k_crop_data_sequence, load_image
 
 
-def predict(model, X, conf, top_K=None, crop_num=30, filemode='local', merge=False, use_multiprocessing=False):
+def predict(model, X, conf, top_K=None, crop_num=30, filemode='local', merge=False, use_multiprocessing=False,
+            batcher=None):
     """
     Predict function.
 
@@ -32,10 +35,15 @@ def predict(model, X, conf, top_K=None, crop_num=30, filemode='local', merge=Fal
     filemode : str, {'local','url'}
         - 'local': filename is absolute path in local disk.
         - 'url': filename is internet url.
+        - 'bytes': X is a list with the contents of encoded image files (eg. the bytes of jpg files).
+        - 'array': X is a list of already decoded RGB images (numpy arrays).
     merge: Merge the predictions of all the images in the list. This value is tipically set to True when you pass
         multiple images of the same observation.
     use_multiprocessing: bool
        Use multiprocessing with the Keras generator.
+    batcher: imgclas.batching.BatchScheduler
+        If provided, the crops of each image are submitted to this scheduler (so that they can be batched together
+        with the images of concurrent requests) instead of being directly fed to the model.
 
     Returns
     -------
@@ -47,7 +55,7 @@ def predict(model, X, conf, top_K=None, crop_num=30, filemode='local', merge=Fal
 
     if top_K is None:
         top_K = conf['model']['num_classes']
-    if type(X) is str: #if not isinstance(X, list):
+    if type(X) in [str, bytes]: #if not isinstance(X, list):
         X = [X]
 
     data_gen = k_crop_data_sequence(inputs=X,
@@ -60,27 +68,67 @@ def predict(model, X, conf, top_K=None, crop_num=30, filemode='local', merge=Fal
                                     crop_number=crop_num,
                                     filemode=filemode)
 
-    output = model.predict(data_gen,
-                           verbose=1,
-                           max_queue_size=10,
-                           workers=4,
-                           use_multiprocessing=use_multiprocessing)
+    if batcher is None:
+        output = model.predict(data_gen,
+                               verbose=1,
+                               max_queue_size=10,
+                               workers=4,
+                               use_multiprocessing=use_multiprocessing)
+    else:
+        # Pipeline the prediction: images are downloaded/decoded (stage 1) and cropped/preprocessed (stage 2) in
+        # separate thread pools, and each image is submitted for prediction (stage 3) as soon as it is ready, so that
+        # a slow image does not hold back the rest
+        crop_futures = [None] * len(X)
+        try:
+            with ThreadPoolExecutor(max_workers=min(8, len(X))) as load_pool, \
+                    ThreadPoolExecutor(max_workers=min(4, len(X))) as crop_pool:
+                load_futures = {load_pool.submit(load_image, x, filemode): i for i, x in enumerate(X)}
+                for f in as_completed(load_futures):
+                    crop_futures[load_futures[f]] = crop_pool.submit(
+                        lambda im: batcher.submit(data_gen.crop_image(im)), f.result())
+            futures = [f.result() for f in crop_futures]
+            output = np.concatenate([f.result() for f in futures], axis=0)
+        except Exception:
+            # Wait for the crops already submitted to the model before failing, so that the caller does not release
+            # (and possibly close) the model while they are still being predicted
+            wait([f.result() for f in crop_futures if f is not None and f.exception() is None])
+            raise
 
     output = output.reshape(len(X), -1, output.shape[-1])  # reshape to (N, crop_number, num_classes)
     output = np.mean(output, axis=1)  # take the mean across the crops
 
     if merge:
-        output = np.mean(output, axis=0)  # take the mean across the images
-        lab = np.argsort(output)[::-1]  # sort labels in descending prob
-        lab = lab[:top_K]  # keep only top_K labels
-        lab = np.expand_dims(lab, axis=0)  # add extra dimension to make to output have a shape (1, top_k)
-        prob = output[lab]
-    else:
-        lab = np.argsort(output, axis=1)[:, ::-1]  # sort labels in descending prob
-        lab = lab[:, :top_K]  # keep only top_K labels
-        prob = output[np.repeat(np.arange(len(lab)), lab.shape[1]),
-                      lab.flatten()].reshape(lab.shape)  # retrieve corresponding probabilities
+        output = np.mean(output, axis=0, keepdims=True)  # take the mean across the images, shape (1, num_classes)
+
+    return top_k(output, top_K)
+
+
+def top_k(output, top_K):
+    """
+    Return the top_K labels (sorted in descending probability) of each prediction.
+    Only the top_K labels are sorted, instead of sorting the whole array of classes.
+
+    Parameters
+    ----------
+    output: np.array, shape (N, num_classes)
+        Array of predicted probabilities
+    top_K: int
+        Number of top predictions to return
+
+    Returns
+    -------
+        pred_lab: np.array, shape (N, top_k)
+            Array of predicted labels
+        pred_prob:  np.array, shape (N, top_k)
+            Array of predicted probabilities
+    """
+    top_K = min(top_K, output.shape[1])
+    lab = np.argpartition(output, -top_K, axis=1)[:, -top_K:]  # top_K labels (unsorted)
+    prob = np.take_along_axis(output, lab, axis=1)  # retrieve corresponding probabilities
 
+    idxs = np.argsort(prob, axis=1)[:, ::-1]  # sort labels in descending prob
+    lab = np.take_along_axis(lab, idxs, axis=1)
+    prob = np.take_along_axis(prob, idxs, axis=1)
     return lab, prob
 
 
@@ -37,6 +37,278 @@ def remove_files(src, extension):
             os.remove(file)
 
 
+# ==========
+# Unit Tests
+# ==========
+
+def test_batch_scheduler():
+    print('Testing unit: batch scheduler ...')
+    import numpy as np
+    from imgclas.batching import BatchScheduler
+
+    batch_sizes = []
+
+    def predict_fn(batch):
+        batch_sizes.append(len(batch))
+        return batch.reshape(len(batch), -1).sum(axis=1)
+
+    # Items submitted within the timeout are coalesced into a single batch and the output is split back
+    batcher = BatchScheduler(predict_fn=predict_fn, max_batch_size=3, batch_timeout_micros=1000000)
+    xs = [np.random.rand(n, 4, 4, 3).astype(np.float32) for n in [2, 1, 3]]
+    futures = [batcher.submit(x) for x in xs]
+    for x, future in zip(xs, futures):
+        np.testing.assert_allclose(future.result(timeout=10), x.reshape(len(x), -1).sum(axis=1), rtol=1e-5)
+    assert batch_sizes == [6], batch_sizes
+
+    # Items beyond the maximum batch size go to the next batch
+    xs = [np.random.rand(1, 4, 4, 3).astype(np.float32) for _ in range(4)]
+    futures = [batcher.submit(x) for x in xs]
+    for x, future in zip(xs, futures):
+        np.testing.assert_allclose(future.result(timeout=10), x.reshape(len(x), -1).sum(axis=1), rtol=1e-5)
+    assert batch_sizes[1:] == [3, 1], batch_sizes
+    batcher.stop()
+
+
+def test_batch_scheduler_exception():
+    print('Testing unit: batch scheduler exceptions ...')
+    import numpy as np
+    from imgclas.batching import BatchScheduler
+
+    def predict_fn(batch):
+        raise ValueError('Prediction failed')
+
+    # All the requests of a failed batch get the exception
+    batcher = BatchScheduler(predict_fn=predict_fn, max_batch_size=2, batch_timeout_micros=1000000)
+    futures = [batcher.submit(np.zeros((1, 4, 4, 3), dtype=np.float32)) for _ in range(2)]
+    for future in futures:
+        assert isinstance(future.exception(timeout=10), ValueError)
+    batcher.stop()
+
+
+def test_batch_scheduler_stop():
+    print('Testing unit: batch scheduler stop ...')
+    import numpy as np
+    from imgclas.batching import BatchScheduler
+
+    def predict_fn(batch):
+        time.sleep(0.2)
+        return batch
+
+    # Stopping waits for the pending items and the consumer threads to finish
+    batcher = BatchScheduler(predict_fn=predict_fn, max_batch_size=1, batch_timeout_micros=0)
+    futures = [batcher.submit(np.zeros((1, 4, 4, 3), dtype=np.float32)) for _ in range(2)]
+    threads = list(batcher.threads)
+    batcher.stop()
+    assert all(f.done() for f in futures)
+    assert not any(t.is_alive() for t in threads)
+
+
+def test_top_k():
+    print('Testing unit: top K predictions ...')
+    import numpy as np
+    from imgclas.test_utils import top_k
+
+    output = np.random.rand(8, 10)
+    for top_K in [1, 5, 10, 20]:
+        lab, prob = top_k(output, top_K)
+        true_lab = np.argsort(output, axis=1)[:, ::-1][:, :top_K]
+        np.testing.assert_array_equal(lab, true_lab)
+        np.testing.assert_array_equal(prob, np.take_along_axis(output, true_lab, axis=1))
+
+
+def test_preprocess_batch():
+    print('Testing unit: batch preprocessing ...')
+    import numpy as np
+    from imgclas.data_utils import preprocess_batch
+
+    batch = [np.random.randint(0, 256, size=(8, 8, 3), dtype=np.uint8) for _ in range(4)]
+    mean_RGB, std_RGB = [120.5, 115.2, 100.9], [60.1, 58.7, 59.3]
+    for mode in ['tf', 'caffe', 'torch']:
+        for channels_first in [False, True]:
+            # Reference float64 implementation
+            true_out = np.array(batch) - np.array(mean_RGB)
+            if mode == 'caffe':
+                true_out = true_out[:, :, :, ::-1]
+            if mode == 'tf':
+                true_out /= 127.5
+            if mode == 'torch':
+                true_out /= np.array(std_RGB)
+            if channels_first:
+                true_out = true_out.transpose(0, 3, 1, 2)
+
+            out = preprocess_batch(batch, mean_RGB=mean_RGB, std_RGB=std_RGB, mode=mode,
+                                   channels_first=channels_first)
+            assert out.dtype == np.float32
+            np.testing.assert_allclose(out, true_out, rtol=1e-5, atol=1e-5)
+
+
+def test_decode_images_gpu():
+    print('Testing unit: gpu decoding ...')
+    import sys
+    import types
+    from unittest import mock
+    import numpy as np
+    from imgclas import data_utils
+
+    pipes = []  # pipelines built so far
+
+    class Output(object):
+        def __init__(self, images):
+            self.images = images
+
+        def as_cpu(self):
+            return self
+
+        def at(self, j):
+            return self.images[j]
+
+    class Pipeline(object):
+        max_batch_size = 2
+
+        def __init__(self):
+            self.fail = not pipes  # the first pipeline fails
+            self.inputs = None
+            pipes.append(self)
+
+        def build(self):
+            pass
+
+        def feed_input(self, name, inputs):
+            self.inputs = inputs
+
+        def run(self):
+            if self.fail:
+                raise RuntimeError('Pipeline failed')
+            return Output([np.zeros((4, 4, 3), dtype=np.uint8) for _ in self.inputs]),
+
+    dali = types.ModuleType('nvidia.dali')
+    dali.fn, dali.types = mock.MagicMock(), mock.MagicMock()
+    dali.pipeline_def = lambda **kwargs: (lambda f: Pipeline)
+    nvidia = types.ModuleType('nvidia')
+    nvidia.dali = dali
+
+    with mock.patch.dict(sys.modules, {'nvidia': nvidia, 'nvidia.dali': dali}), \
+            mock.patch.dict(data_utils.gpu_decoder, clear=True):
+
+        # A failed pipeline is dropped and the file that is not an image raises an error when decoded on the CPU
+        try:
+            data_utils.decode_images_gpu([b'not an image'])
+        except ValueError:
+            pass
+        else:
+            raise Exception('Decoding a file that is not an image should raise an error.')
+        assert 'pipe' not in data_utils.gpu_decoder
+
+        # The next call rebuilds the pipeline
+        images = data_utils.decode_images_gpu([b'image'] * 3)
+        assert len(pipes) == 2 and data_utils.gpu_decoder['pipe'] is pipes[1]
+        assert len(images) == 3
+
+
+def fake_model_cache(api, loaded, closed, load_time=0.):
+    """
+    Patch the api so that models are not loaded from disk. The keys of the loaded and closed models are appended to
+    the `loaded` and `closed` lists.
+    """
+    from collections import OrderedDict
+    from unittest import mock
+
+    def load_model_files(timestamp, ckpt_name):
+        time.sleep(load_time)
+        loaded.append((timestamp, ckpt_name))
+        return {'key': (timestamp, ckpt_name), 'session': None, 'model': None, 'infer': None, 'conf': None,
+                'class_names': None, 'class_info': None, 'class_meta': None, 'inflight': 0, 'evicted': False}
+
+    loaded_vars = ['loaded_ts', 'loaded_ckpt', 'loaded_entry', 'session', 'model', 'infer', 'conf', 'class_names',
+                   'class_info', 'class_meta']
+    return mock.patch.multiple(api,
+                               load_model_files=load_model_files,
+                               close_model=lambda entry: closed.append(entry['key']),
+                               find_model=lambda timestamp, ckpt_name: (timestamp, ckpt_name),
+                               model_cache=OrderedDict(),
+                               model_cache_size=2,
+                               loading={},
+                               **{k: None for k in loaded_vars})
+
+
+def test_model_cache_shared_load():
+    print('Testing unit: model cache shared load ...')
+    from concurrent.futures import ThreadPoolExecutor
+    from imgclas import api
+
+    # Concurrent requests for the same model wait for the same load
+    loaded, closed = [], []
+    with fake_model_cache(api, loaded, closed, load_time=0.2):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            entries = list(pool.map(lambda _: api.load_inference_model('A', 'ckpt'), range(4)))
+        assert loaded == [('A', 'ckpt')], loaded
+        assert all(e is entries[0] for e in entries)
+        assert api.loaded_entry is entries[0]
+
+
+def test_model_cache_eviction():
+    print('Testing unit: model cache eviction ...')
+    from imgclas import api
+
+    # The least recently used model is evicted when the cache is full
+    loaded, closed = [], []
+    with fake_model_cache(api, loaded, closed):
+        for ts in ['A', 'B', 'C']:
+            api.load_inference_model(ts, 'ckpt')
+        assert list(api.model_cache) == [('B', 'ckpt'), ('C', 'ckpt')]
+        assert closed == [('A', 'ckpt')], closed
+
+        api.load_inference_model('B', 'ckpt')  # B is now the most recently used
+        api.load_inference_model('D', 'ckpt')
+        assert list(api.model_cache) == [('B', 'ckpt'), ('D', 'ckpt')]
+        assert closed == [('A', 'ckpt'), ('C', 'ckpt')], closed
+
+
+def test_model_cache_inflight():
+    print('Testing unit: model cache in-flight requests ...')
+    from imgclas import api
+
+    # An evicted model is only closed once its last request is released
+    loaded, closed = [], []
+    with fake_model_cache(api, loaded, closed):
+        entry = api.load_inference_model('A', 'ckpt', acquire=True)
+        api.load_inference_model('A', 'ckpt', acquire=True)
+        for ts in ['B', 'C']:
+            api.load_inference_model(ts, 'ckpt')
+        assert entry['evicted'] and not closed
+
+        api.release_model(entry)
+        assert not closed
+        api.release_model(entry)
+        assert closed == [('A', 'ckpt')], closed
+
+
+def test_model_cache_evicted_after_lookup():
+    print('Testing unit: model cache eviction after lookup ...')
+    from unittest import mock
+    from imgclas import api
+
+    # A request that gets a model evicted (by another request) before using it reloads the model
+    loaded, closed = [], []
+    with fake_model_cache(api, loaded, closed):
+        old_entry = api.load_inference_model('A', 'ckpt')
+        get_model = api.get_model
+
+        def evicting_get_model(key):
+            entry = get_model(key)
+            if entry is old_entry:
+                with api.model_lock:
+                    api.model_cache.pop(key)
+                    entry['evicted'] = True
+            return entry
+
+        with mock.patch.object(api, 'get_model', evicting_get_model):
+            entry = api.load_inference_model('A', 'ckpt')
+        assert entry is not old_entry and not entry['evicted']
+        assert loaded == [('A', 'ckpt')] * 2, loaded
+        assert api.loaded_entry is entry
+
+
 # ===========
 # Local Tests
 # ===========
@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration to serve the image classification webpage
+
+Usage:
+gunicorn serve:app -c gunicorn.conf.py
+
+Notes:
+We use a single worker so that the model is loaded only once in memory. Concurrent requests are handled by the
+worker threads, which share the loaded models (each request uses the configuration and model selected by its own
+query, see the notes in imgclas/api.py).
+The model is loaded when the worker imports serve.py. The app is not preloaded in the master process because
+Tensorflow sessions are not fork-safe, so a model loaded before forking would leave the worker with an unusable
+session.
+"""
+
+workers = 1
+threads = 8
+worker_class = 'gthread'
+preload_app = False
+timeout = 120
@@ -9,6 +9,7 @@ Github: ignacioheredia
 Description:
 This script launches a basic webpage interface to return results for image classification prediction.
 To launch this webpage you can run `python serve.py`.
+To launch it in production mode you can run `gunicorn serve:app -c gunicorn.conf.py`.
 
 Tip:
 To host the app in a subpath through a proxy_pass with nginx check Ross's anwer in [1].
@@ -36,7 +37,7 @@ else:
     app.secret_key = 'devkey, should be in a file'
 
 # Load model
-if not api.loaded:
+if api.model is None:
     api.load_inference_model()
 
 # Create labels.html from synsets.txt
@@ -116,6 +117,20 @@ def api_fn():
     return resp
 
 
+@app.route('/infer-batch', methods=['POST'])
+def infer_batch():
+    """
+    Predict a batch of independent images (urls or files) in a single request
+    """
+    args = {'urls': request.form.getlist('url_list') or None,
+            'files': request.files.getlist('files') or None}
+    message = api.predict_batch(**args)
+
+    js = json.dumps(message)
+    status = 200 if message['status'] == 'OK' else 400
+    return Response(js, status=status, mimetype='application/json')
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     flash(Markup(e))